@@ -2,9 +2,9 @@
 pcachefs package.
 """
 
-from pcachefs import main
+from .pcachefs import main
 
-from pcachefs import FuseStat
-from pcachefs import PersistentCacheFs
-from pcachefs import Cacher
-from pcachefs import UnderlyingFs
+from .pcachefs import FuseStat
+from .pcachefs import PersistentCacheFs
+from .pcachefs import Cacher
+from .pcachefs import UnderlyingFs
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 """
    Persistent caching FUSE filesystem
@@ -19,35 +19,122 @@
 
 """
 
+# We explicitly refer to builtins here so it can be mocked
+import builtins
+import collections
+import concurrent.futures
+import functools
+import mmap
+import operator
 import os
-import pickle
+import queue
 import signal
 import stat
-# We explicitly refer to __builtin__ here so it can be mocked
-import __builtin__
+import struct
+import threading
+import time
 
 from pprint import pformat
 
 import fuse
 
-import vfs
-from ranges import (Ranges, Range)
-from pcachefsutil import debug, is_read_only_flags
-from pcachefsutil import E_PERM_DENIED, E_NOT_IMPL
+from . import pcachefsutil
+from . import vfs
+from .ranges import (Ranges, Range, coalesce)
+from .pcachefsutil import debug, is_read_only_flags, copy_range, preallocate
+from .pcachefsutil import E_PERM_DENIED, E_NOT_IMPL
 
 
 fuse.fuse_python_api = (0, 2)
 
+# Maximum number of entries held in each of the Cacher's in-memory
+# stat and directory listing caches
+MEM_CACHE_SIZE = 8192
+
+# Maximum number of cache.data file descriptors the Cacher keeps open,
+# for each of reading and writing
+FD_CACHE_SIZE = 64
+
+# cache.data files at least this large are memory mapped for reading
+MMAP_THRESHOLD = 1024 * 1024
+
+# Data is fetched from the underlying filesystem in aligned chunks of
+# this size (which must be a power of two), and uncached blocks closer
+# together than MERGE_THRESHOLD are fetched in a single read
+READ_CHUNK_SIZE = 1024 * 1024
+MERGE_THRESHOLD = 64 * 1024
+
+# Number of bytes following each read that are fetched into the cache
+# in the background
+READAHEAD_SIZE = 4 * 1024 * 1024
+
+# Maximum number of blocks fetched from the underlying filesystem at the
+# same time when a read needs several
+FETCH_CONCURRENCY = 4
+
+# Maximum number of seconds changes to the cached ranges of a file are
+# kept in memory before being written to disk
+FLUSH_INTERVAL = 5.0
+
+# Default number of seconds entries in the in-memory caches are
+# considered fresh
+DEFAULT_MEM_CACHE_TTL = 60.0
+
+# On-disk layout of cache.meta: the FuseStat fields in the order given
+# by STAT_FIELDS, st_size as int64, timestamps as doubles and everything
+# else (which is unsigned, and may use all 64 bits for st_ino and
+# st_dev) as uint64, then the number of cached ranges followed by the
+# ranges themselves (as packed by Ranges.pack())
+STAT_FIELDS = ('st_mode', 'st_nlink', 'st_size',
+               'st_atime', 'st_mtime', 'st_ctime',
+               'st_dev', 'st_gid', 'st_ino', 'st_uid',
+               'st_rdev', 'st_blksize')
+_get_stat_fields = operator.attrgetter(*STAT_FIELDS)
+_STAT_STRUCT = struct.Struct('<2Qq3d6Q')
+_RANGE_COUNT_STRUCT = struct.Struct('<I')
+_META_HEADER_SIZE = _STAT_STRUCT.size + _RANGE_COUNT_STRUCT.size
+
+
+def _synchronized(method):
+    """Decorator running a Cacher method while holding the Cacher's lock."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+@functools.lru_cache(maxsize=4096)
+def _real_path(real_root, path):
+    """Return the path in the underlying filesystem rooted at real_root for path."""
+    if path[0] != '/':
+        raise ValueError("Expected leading slash")
+
+    return os.path.join(real_root, path[1:])
+
+
+@functools.lru_cache(maxsize=4096)
+def _cache_path(cachedir, path, file):
+    """Return the path in cachedir of the given cache file for path, or of its directory if file is None."""
+    if path[0] != '/':
+        raise ValueError("Expected leading slash")
+
+    if file is None:
+        return os.path.join(cachedir, path[1:])
+
+    return os.path.join(cachedir, path[1:], file)
+
 
 class FuseStat(fuse.Stat):
     """Convenient class for Stat objects.
 
     Set up the stat object based on values from the given stat object
     (which should come from os.stat()).
-    """
-    def __init__(self, st):
-        fuse.Stat.__init__(self)
 
+    fuse.Stat.__init__() is not called, as it only sets defaults for
+    fields which are all overwritten here.
+    """
+    def __init__(self, st):  # pylint: disable=super-init-not-called
         self.st_mode = st.st_mode
         self.st_nlink = st.st_nlink
         self.st_size = st.st_size
@@ -63,8 +150,24 @@ class FuseStat(fuse.Stat):
         self.st_rdev = st.st_rdev
         self.st_blksize = st.st_blksize
 
+    @classmethod
+    def from_tuple(cls, t):
+        """Create a FuseStat from a tuple of values ordered as STAT_FIELDS."""
+        result = cls.__new__(cls)
+
+        (result.st_mode, result.st_nlink, result.st_size,
+         result.st_atime, result.st_mtime, result.st_ctime,
+         result.st_dev, result.st_gid, result.st_ino, result.st_uid,
+         result.st_rdev, result.st_blksize) = t
+
+        return result
+
+    def to_tuple(self):
+        """Return the values of this FuseStat ordered as STAT_FIELDS."""
+        return _get_stat_fields(self)
+
     def __repr__(self):
-        v = vars(self)
+        v = dict(vars(self))
         v['is_dir'] = stat.S_ISDIR(v['st_mode'])
         v['is_char_dev'] = stat.S_ISCHR(v['st_mode'])
         v['is_block_dev'] = stat.S_ISBLK(v['st_mode'])
@@ -90,6 +193,9 @@ class PersistentCacheFs(fuse.Fuse):
         self.parser.add_option('-c', '--cache-dir', dest='cache_dir', help="Specifies the directory where cached data should be stored. This will be created if it does not exist.")
         self.parser.add_option('-t', '--target-dir', dest='target_dir', help="The directory which we are caching. The content of this directory will be mirrored and all reads cached.")
         self.parser.add_option('-v', '--virtual-dir', dest='virtual_dir', help="The folder in the mount dir in which the virtual filesystem controlling pcachefs will reside.")
+        self.parser.add_option('--debug', dest='debug', action='store_true', default=False, help="Log every operation to stderr.")
+        self.parser.add_option('--stat-ttl', dest='stat_ttl', type='float', default=DEFAULT_MEM_CACHE_TTL, help="Number of seconds file attributes are kept in memory before being reloaded from the cache dir and checked against the target dir.")
+        self.parser.add_option('--list-ttl', dest='list_ttl', type='float', default=DEFAULT_MEM_CACHE_TTL, help="Number of seconds directory listings are kept in memory before being reloaded from the cache dir, and directories are trusted after being checked against the target dir.")
 
         self.cache_dir = None
         self.target_dir = None
@@ -97,6 +203,12 @@ class PersistentCacheFs(fuse.Fuse):
         self.cacher = None
         self.vfs = None
 
+        # Path of the virtual dir in the mount, and prefix of paths within
+        # it, for telling which operations to delegate to self.vfs. These
+        # are self.vfs's own, held here to inline VirtualFS.contains().
+        self._vroot = None
+        self._vprefix = None
+
     def main(self, args=None):
         options = self.cmdline[0]
 
@@ -105,36 +217,46 @@ class PersistentCacheFs(fuse.Fuse):
         if options.target_dir is None:
             self.parser.error('Need to specify --target-dir')
 
+        pcachefsutil.DEBUG = options.debug
+
         self.cache_dir = options.cache_dir
         self.target_dir = options.target_dir
         self.virtual_dir = options.virtual_dir or '.pcachefs'
 
-        self.cacher = Cacher(self.cache_dir, UnderlyingFs(self.target_dir))
+        self.cacher = Cacher(self.cache_dir, UnderlyingFs(self.target_dir),
+                             stat_ttl=options.stat_ttl, list_ttl=options.list_ttl)
         self.vfs = vfs.VirtualFS(self.virtual_dir, self.cacher)
+        self._vroot = self.vfs.root_path
+        self._vprefix = self.vfs.root_prefix
 
         signal.signal(signal.SIGINT, signal.SIG_DFL)
-        fuse.Fuse.main(self, args)
+        try:
+            fuse.Fuse.main(self, args)
+        finally:
+            self.cacher.flush_all()
 
     def getattr(self, path):
-        debug('PersistentCacheFs.getattr', path)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.getattr', path)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.getattr(path)
 
         return self.cacher.getattr(path)
 
     def readdir(self, path, offset):
-        debug('PersistentCacheFs.readdir', path, offset)
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.readdir', path, offset)
         for f in self.vfs.readdir(path, offset):
             if f is None:
                 return
             yield f
 
-        for f in self.cacher.readdir(path, offset):
-            yield f
+        yield from self.cacher.readdir(path, offset)
 
     def open(self, path, flags):
-        debug('PersistentCacheFs.open', path, flags)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.open', path, flags)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.open(path, flags)
 
         if not is_read_only_flags(flags):
@@ -143,36 +265,42 @@ class PersistentCacheFs(fuse.Fuse):
         return 0
 
     def read(self, path, size, offset):
-        debug('PersistentCacheFs.read', path, size, offset)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.read', path, size, offset)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.read(path, size, offset)
 
         return self.cacher.read(path, size, offset)
 
     def truncate(self, path, size):
-        debug('PersistentCacheFs.truncate', path, size)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.truncate', path, size)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.truncate(path, size)
 
         return E_NOT_IMPL
 
     def write(self, path, buf, offset):
-        debug('PersistentCacheFs.write', path, buf, offset)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.write', path, buf, offset)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.write(path, buf, offset)
 
         return E_NOT_IMPL
 
     def flush(self, path):
-        debug('PersistentCacheFs.flush', path)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.flush', path)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.flush(path)
 
+        self.cacher.flush(path)
         return 0 # success
 
     def release(self, path, what):
-        debug('PersistentCacheFs.release', path, what)
-        if self.vfs.contains(path):
+        if pcachefsutil.DEBUG:
+            debug('PersistentCacheFs.release', path, what)
+        if path == self._vroot or path.startswith(self._vprefix):
             return self.vfs.release(path)
 
         return 0 # success
@@ -221,18 +349,20 @@ class UnderlyingFs(object):
     def __init__(self, real_path):
         self.real_path = real_path
 
-    def _get_real_path(self, path):
-        if path[0] != '/':
-            raise ValueError("Expected leading slash")
+        # LRU cache of read-only file descriptors, keyed by path
+        self._fd_cache = collections.OrderedDict()
 
-        return os.path.join(self.real_path, path[1:])
+    def _get_real_path(self, path):
+        return _real_path(self.real_path, path)
 
     def getattr(self, path):
-        debug('UnderlyingFs.getattr', path)
+        if pcachefsutil.DEBUG:
+            debug('UnderlyingFs.getattr', path)
         return FuseStat(os.stat(self._get_real_path(path)))
 
     def readdir(self, path, offset):
-        debug('UnderlyingFs.readdir', path, offset)
+        if pcachefsutil.DEBUG:
+            debug('UnderlyingFs.readdir', path, offset)
         real_path = self._get_real_path(path)
 
         dirents = []
@@ -245,15 +375,41 @@ class UnderlyingFs(object):
         return (fuse.Direntry(r) for r in dirents)
 
     def read(self, path, size, offset):
-        debug('UnderlyingFs.read', path, size, offset)
+        if pcachefsutil.DEBUG:
+            debug('UnderlyingFs.read', path, size, offset)
         real_path = self._get_real_path(path)
 
-        with __builtin__.open(real_path, 'rb') as f:
+        with builtins.open(real_path, 'rb') as f:
             f.seek(offset)
             result = f.read(size)
 
         return result
 
+    def open_fd(self, path):
+        """Return a read-only file descriptor on the given file.
+
+        Descriptors are kept open and reused across calls, the least
+        recently used one being closed once FD_CACHE_SIZE are open.
+        """
+        fd = self._fd_cache.get(path)
+        if fd is not None:
+            self._fd_cache.move_to_end(path)
+            return fd
+
+        fd = os.open(self._get_real_path(path), os.O_RDONLY)
+
+        if len(self._fd_cache) >= FD_CACHE_SIZE:
+            os.close(self._fd_cache.popitem(last=False)[1])
+
+        self._fd_cache[path] = fd
+        return fd
+
+    def close_fd(self, path):
+        """Close the file descriptor held open on the given file, if any."""
+        fd = self._fd_cache.pop(path, None)
+        if fd is not None:
+            os.close(fd)
+
 
 class Cacher(object):
     """
@@ -267,14 +423,14 @@ class Cacher(object):
 
     The cached files are stored as follows in the cache directory:
       /cache/dir/filename.ext/cache.data   # copy of file data
-      /cache/dir/filename.ext/cache.stat  # pickle'd stat object (from os.stat())
-      /cache/dir/cache.list # pickle'd directory listing (from os.listdir())
+      /cache/dir/filename.ext/cache.meta  # packed stat fields (from os.stat()) and ranges of cache.data which have been fetched
+      /cache/dir/cache.names # NUL separated directory listing (from os.listdir())
 
     For writes to files in the cache, these are passed through to the
     underlying filesystem without any caching.
     """
 
-    def __init__(self, cachedir, underlying_fs):
+    def __init__(self, cachedir, underlying_fs, stat_ttl=DEFAULT_MEM_CACHE_TTL, list_ttl=DEFAULT_MEM_CACHE_TTL):
         """
         Initialise a new Cacher.
 
@@ -283,7 +439,13 @@ class Cacher(object):
         underlying_fs an object supporting the read(), readdir() and
         getattr() FUSE operations. For any files/dirs not in the cache,
         this object's methods will be called to retrieve the real data
-        and populate the cache.
+        and populate the cache. If it also has open_fd() and close_fd()
+        methods, file data is copied from the returned descriptors
+        instead of using read().
+        stat_ttl, list_ttl the number of seconds stat objects and
+        directory listings are served from memory before being reloaded
+        from cachedir. A directory is also not checked against
+        underlying_fs again until list_ttl seconds after the last check.
         """
         self.cachedir = cachedir
         self.underlying_fs = underlying_fs
@@ -292,165 +454,650 @@ class Cacher(object):
         # requests are made for data that does not exist in the cache
         self.cache_only_mode = False
 
-
-        if not os.path.exists(self.cachedir):
-            self._mkdir(self.cachedir)
+        # In-memory LRU caches in front of cache.meta and cache.names,
+        # keyed by path. Values are (value, expiry) tuples.
+        self.stat_ttl = stat_ttl
+        self.list_ttl = list_ttl
+        self._stat_mem = collections.OrderedDict()
+        self._list_mem = collections.OrderedDict()
+
+        # Cached ranges, keyed by path, and the paths whose ranges have
+        # changed since they were last written to cache.meta
+        self._ranges_mem = collections.OrderedDict()
+        self._ranges_dirty = set()
+        self._flush_timer = None
+
+        # LRU caches of open cache.data file descriptors, keyed by path
+        self._fd_cache = collections.OrderedDict()
+        self._rw_fd_cache = collections.OrderedDict()
+
+        # Read-only memory maps of the larger files in self._fd_cache,
+        # keyed by path. Files are only mapped once cache.data is as
+        # large as them, and reads beyond a map fall back to pread().
+        self._mmap_cache = {}
+
+        # Read-ahead is done by a worker thread, which is only started
+        # on the first read so that it is created after FUSE has forked
+        # into the background. All state above is shared with it, so
+        # public methods hold self._lock.
+        self._lock = threading.RLock()
+        self._prefetch_queue = queue.Queue()
+        self._prefetch_thread = None
+
+        # Offset of the read-ahead window queued or being fetched for
+        # each path, of which there is at most one per path
+        self._readahead = {}
+
+        # Blocks the worker is copying without holding self._lock, keyed
+        # by path. self._fetched is notified when a copy ends.
+        self._fetching = {}
+        self._fetched = threading.Condition(self._lock)
+
+        # Fetches blocks concurrently; its threads are started on demand
+        self._fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY,
+                                                                     thread_name_prefix='pcachefs-fetch')
+
+        self._mkdir(self.cachedir)
 
     def cache_only_mode_enable(self):
-        debug('Cacher.cache_only_mode_enable')
+        if pcachefsutil.DEBUG:
+            debug('Cacher.cache_only_mode_enable')
         self.cache_only_mode = True
 
     def cache_only_mode_disable(self):
-        debug('Cacher.cache_only_mode_disable')
+        if pcachefsutil.DEBUG:
+            debug('Cacher.cache_only_mode_disable')
         self.cache_only_mode = False
 
+    @_synchronized
     def get_cached_blocks(self, path):
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
-
-        cached_blocks = None
-        if os.path.exists(data_cache_range):
-            with __builtin__.open(data_cache_range, 'rb') as f:
-                cached_blocks = pickle.load(f)
-        else:
-            cached_blocks = Ranges()
-
+        cached_blocks = self._ranges_mem.get(path)
+        if cached_blocks is not None:
+            self._ranges_mem.move_to_end(path)
+            return cached_blocks
+
+        cache_meta = self._get_cache_dir(path, 'cache.meta')
+
+        cached_blocks = Ranges()
+        try:
+            with builtins.open(cache_meta, 'rb') as f:
+                meta = f.read()
+        except FileNotFoundError:
+            meta = b''
+
+        # If the ranges do not match their count, cache.meta was only
+        # partly written, and the data is fetched again
+        if len(meta) >= _META_HEADER_SIZE:
+            count, = _RANGE_COUNT_STRUCT.unpack_from(meta, _STAT_STRUCT.size)
+            if len(meta) == _META_HEADER_SIZE + 16 * count:
+                cached_blocks = Ranges.unpack(meta[_META_HEADER_SIZE:])
+
+        self._put_cached_blocks(path, cached_blocks)
         return cached_blocks
 
+    @_synchronized
     def update_cached_blocks(self, path, cached_blocks):
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
+        """Record the cached ranges for path.
+
+        The ranges are kept in memory and written to cache.meta by
+        flush(), which happens at the latest FLUSH_INTERVAL seconds
+        later.
+        """
+        self._put_cached_blocks(path, cached_blocks)
+        self._ranges_dirty.add(path)
 
-        with __builtin__.open(data_cache_range, 'wb') as f:
-            pickle.dump(cached_blocks, f)
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(FLUSH_INTERVAL, self._flush_timer_expired)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
 
+    @_synchronized
     def remove_cached_blocks(self, path):
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
+        self._invalidate_mem(path)
+        self._close_cached_fds(path)
+        self._remove_cached_blocks(path)
+
+    @_synchronized
+    def flush(self, path):
+        """Write the cached ranges for path to disk if they have changed."""
+        if path not in self._ranges_dirty:
+            return
+
+        self._ranges_dirty.discard(path)
+        self._write_meta_ranges(path, self._ranges_mem[path])
+
+    @_synchronized
+    def flush_all(self):
+        """Write all changed cached ranges to disk."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
 
-        os.remove(data_cache_range)
+        for path in list(self._ranges_dirty):
+            self.flush(path)
+
+    def _flush_timer_expired(self):
+        self.flush_all()
+
+    def _put_cached_blocks(self, path, cached_blocks):
+        """Keep cached_blocks in memory, writing out the least recently used entry if full."""
+        self._ranges_mem[path] = cached_blocks
+        self._ranges_mem.move_to_end(path)
+
+        if len(self._ranges_mem) > MEM_CACHE_SIZE:
+            oldest = next(iter(self._ranges_mem))
+            self.flush(oldest)
+            del self._ranges_mem[oldest]
+
+    def _remove_cached_blocks(self, path):
+        """Forget the cached ranges for path, both in memory and on disk."""
+        self._ranges_mem.pop(path, None)
+        self._ranges_dirty.discard(path)
+
+        self._write_meta_ranges(path, Ranges())
+
+    def _write_meta_ranges(self, path, cached_blocks):
+        """Replace the ranges stored in the cache.meta file for path."""
+        packed = cached_blocks.pack()
+        data = _RANGE_COUNT_STRUCT.pack(len(packed) // 16) + packed
+
+        try:
+            fd = os.open(self._get_cache_dir(path, 'cache.meta'), os.O_WRONLY)
+        except FileNotFoundError:
+            # Nothing is cached for path any more
+            return
+
+        try:
+            os.pwrite(fd, data, _STAT_STRUCT.size)
+            os.ftruncate(fd, _STAT_STRUCT.size + len(data))
+        finally:
+            os.close(fd)
 
     def get_cached_data(self, path, size, offset):
-        cache_data = self._get_cache_dir(path, 'cache.data')
+        fd = self._get_cached_fd(path)
 
-        result = None
-        with __builtin__.open(cache_data, 'rb') as f:
-            f.seek(offset)
-            result = f.read(size)
+        mm = self._mmap_cache.get(path)
+        if mm is not None and offset + size <= len(mm):
+            return mm[offset:offset + size]
 
-        return result
+        return os.pread(fd, size, offset)
 
     def init_cached_data(self, path):
         cache_data = self._get_cache_dir(path, 'cache.data')
 
-        if os.path.exists(cache_data):
+        try:
+            os.stat(cache_data)
             return
+        except FileNotFoundError:
+            pass
 
         file_stat = self.getattr(path)
         self._create_cache_dir(path)
 
-        with __builtin__.open(cache_data, 'wb') as f:
-            f.truncate()
-            f.seek(file_stat.st_size - 1)
-            f.write('\0')
+        fd = os.open(cache_data, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            preallocate(fd, file_stat.st_size)
+        except:
+            # Do not leave a cache.data that looks initialised
+            os.remove(cache_data)
+            raise
+        finally:
+            os.close(fd)
 
     def update_cached_data(self, path, blocks_to_read):
         if not blocks_to_read:
             return
 
-        cache_data = self._get_cache_dir(path, 'cache.data')
+        # Open it up for writing so we can add data to it as we read the
+        # data from the underlying filesystem
+        fd = self._get_cached_fd(path, writable=True)
 
-        # Now open it up in update mode so we can add data to it as
-        # we read the data from the underlying filesystem
-        with __builtin__.open(cache_data, 'r+b') as cache_data_file:
+        # If possible, have the kernel copy the data across directly
+        if hasattr(self.underlying_fs, 'open_fd'):
+            src_fd = self.underlying_fs.open_fd(path)
 
-            # Now loop through all the blocks we need to get
-            # and append them to the cached file as we go
-            for block in blocks_to_read:
-                block_data = self.underlying_fs.read(path, block.size, block.start)
+            if len(blocks_to_read) == 1:
+                copy_range(src_fd, fd, blocks_to_read[0].start, blocks_to_read[0].size)
+                return
+
+            # Fetch the blocks concurrently, so that we wait for the
+            # slowest one rather than for all of them in turn
+            cache_data = self._get_cache_dir(path, 'cache.data')
+            futures = [self._fetch_executor.submit(self._copy_block, src_fd, cache_data, block)
+                       for block in blocks_to_read]
+            for future in futures:
+                future.result()
 
-                cache_data_file.seek(block.start)
-                cache_data_file.write(block_data) # overwrites existing data in the file
+            return
 
+        # Now loop through all the blocks we need to get
+        # and write them to the cached file as we go
+        for block in blocks_to_read:
+            block_data = self.underlying_fs.read(path, block.size, block.start)
+            os.pwrite(fd, block_data, block.start) # overwrites existing data in the file
+
+    @staticmethod
+    def _copy_block(src_fd, cache_data, block):
+        """Copy block from src_fd into cache_data through a descriptor of its own."""
+        # copy_range() may move the file offset of the destination, so
+        # concurrent copies must not share one
+        fd = os.open(cache_data, os.O_WRONLY)
+        try:
+            copy_range(src_fd, fd, block.start, block.size)
+        finally:
+            os.close(fd)
+
+    @_synchronized
     def remove_cached_data(self, path):
+        self._invalidate_mem(path)
+        self._close_cached_fds(path)
+
         data_cache = self._get_cache_dir(path, 'cache.data')
         os.remove(data_cache)
 
-        data_cache_range = self._get_cache_dir(path, 'cache.data.range')
-        os.remove(data_cache_range)
+        self._remove_cached_blocks(path)
 
     def read(self, path, size, offset, force_reload=False):
         """Read the given data from the given path on the filesystem.
 
         Any parts which are requested and are not in the cache are read
-        from the underlying filesystem
+        from the underlying filesystem. Reads which are entirely cached
+        are served straight from cache.data.
         """
-        debug('Cacher.read', path, size, offset)
+        if pcachefsutil.DEBUG:
+            debug('Cacher.read', path, size, offset)
+
+        if not force_reload:
+            with self._lock:
+                # getattr() discards the cached ranges if the file has
+                # changed, so it must come first
+                self.getattr(path)
+                cached_blocks = self.get_cached_blocks(path)
+                if cached_blocks.contains(Range(offset, offset + size)):
+                    result = self.get_cached_data(path, size, offset)
+                    self._schedule_readahead(path, cached_blocks, offset + size)
+                    return result
+
+        with self._lock:
+            self.init_cached_data(path)
+
+            if force_reload:
+                self.remove_cached_blocks(path)
+
+            self._fill(path, size, offset)
+            result = self.get_cached_data(path, size, offset)
+
+            self._schedule_readahead(path, self.get_cached_blocks(path), offset + size)
+            return result
+
+    def _fill(self, path, size, offset):
+        """Fetch any uncached parts of the given range into the cache."""
+        while True:
+            # getattr() may find the file has changed and discard its
+            # cached ranges, so it must come first
+            file_size = self.getattr(path).st_size
+            cached_blocks = self.get_cached_blocks(path)
+
+            # If the worker is copying part of the range, wait for it
+            # rather than fetching the same data again
+            fetching = self._fetching.get(path, ())
+            if not any(block.start < offset + size and offset < block.end for block in fetching):
+                break
+            self._fetched.wait()
+
+        blocks_to_read = self._get_blocks_to_read(cached_blocks, file_size, size, offset)
+
+        # Leave what the worker is copying beyond the range to it
+        if fetching:
+            in_flight = Ranges().add_ranges(fetching)
+            blocks_to_read = [portion for block in blocks_to_read for portion in in_flight.get_uncovered_portions(block)]
 
-        self.init_cached_data(path)
-
-        if force_reload:
-            self.remove_cached_blocks(path)
-
-        cached_blocks = self.get_cached_blocks(path)
-        blocks_to_read = cached_blocks.get_uncovered_portions(Range(offset, offset+size))
+        if not blocks_to_read:
+            return
 
         self.update_cached_data(path, blocks_to_read)
         self.update_cached_blocks(path, cached_blocks.add_ranges(blocks_to_read))
 
-        return self.get_cached_data(path, size, offset)
+    def _schedule_readahead(self, path, cached_blocks, offset):
+        """Prefetch the READAHEAD_SIZE bytes of path from offset, unless they are past its end or cached already.
+
+        Nothing is queued while an earlier window of path is pending, so
+        that the queue holds at most one job per path.
+        """
+        if path in self._readahead:
+            return
+
+        end = min(offset + READAHEAD_SIZE, self.getattr(path).st_size)
+        if end > offset and not cached_blocks.contains(Range(offset, end)):
+            self._readahead[path] = offset
+            self._schedule_prefetch(path, offset)
+
+    def _schedule_prefetch(self, path, offset):
+        """Queue READAHEAD_SIZE bytes of path from offset to be cached in the background."""
+        if self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(target=self._prefetch_worker, name='pcachefs-prefetch')
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+
+        self._prefetch_queue.put((path, offset))
+
+    def _prefetch_worker(self):
+        while True:
+            path, offset = self._prefetch_queue.get()
+            try:
+                self._prefetch(path, offset)
+            except Exception as e:
+                if pcachefsutil.DEBUG:
+                    debug('Cacher._prefetch failed', path, offset, e)
+            finally:
+                with self._lock:
+                    self._readahead.pop(path, None)
+
+    def _prefetch(self, path, offset):
+        """Cache READAHEAD_SIZE bytes of path from offset.
+
+        self._lock is only held to decide what to fetch and to record
+        it once fetched, so that other operations do not wait for the
+        underlying filesystem meanwhile.
+        """
+        if pcachefsutil.DEBUG:
+            debug('Cacher._prefetch', path, offset)
+
+        cache_data = self._get_cache_dir(path, 'cache.data')
+
+        with self._lock:
+            # Do not bring back data that was removed from the cache
+            # after the read was queued
+            if not os.path.exists(cache_data):
+                return
+
+            file_size = self.getattr(path).st_size
+            size = min(READAHEAD_SIZE, file_size - offset)
+            if size <= 0:
+                return
+
+            cached_blocks = self.get_cached_blocks(path)
+            blocks_to_read = self._get_blocks_to_read(cached_blocks, file_size, size, offset)
+            if not blocks_to_read:
+                return
+
+            # The descriptors in our caches may be closed by other
+            # operations while we copy, so use our own
+            fd = os.open(cache_data, os.O_WRONLY)
+            try:
+                src_fd = os.dup(self.underlying_fs.open_fd(path)) if hasattr(self.underlying_fs, 'open_fd') else None
+            except:
+                os.close(fd)
+                raise
+
+            self._fetching[path] = blocks_to_read
+
+        copied = False
+        try:
+            for block in blocks_to_read:
+                if src_fd is not None:
+                    copy_range(src_fd, fd, block.start, block.size)
+                else:
+                    os.pwrite(fd, self.underlying_fs.read(path, block.size, block.start), block.start)
+            copied = True
+
+        finally:
+            os.close(fd)
+            if src_fd is not None:
+                os.close(src_fd)
+
+            with self._lock:
+                del self._fetching[path]
+
+                # If the cache for path was invalidated while we copied,
+                # its ranges were replaced and what we fetched is dropped
+                if copied and self._ranges_mem.get(path) is cached_blocks:
+                    self.update_cached_blocks(path, cached_blocks.add_ranges(blocks_to_read))
+
+                self._fetched.notify_all()
+
+    def _get_blocks_to_read(self, cached_blocks, file_size, size, offset):  # pylint: disable=no-self-use
+        """Determine which blocks to fetch from the underlying filesystem for a read.
+
+        The requested range is widened to READ_CHUNK_SIZE boundaries
+        (clamped to the size of the file), so that small reads fill the
+        cache in bulk, and the uncached portions of it that are close
+        together are merged into single blocks.
+        """
+        mask = READ_CHUNK_SIZE - 1
 
+        start = offset & ~mask
+        end = max(min((offset + size + mask) & ~mask, file_size), offset + size)
 
+        blocks_to_read = cached_blocks.get_uncovered_portions(Range(start, end))
+        return coalesce(blocks_to_read, MERGE_THRESHOLD)
+
+    @_synchronized
     def readdir(self, path, offset):
         """List the given directory, from the cache."""
-        debug('Cacher.readdir', path, offset)
-        cache_dir = self._get_cache_dir(path, 'cache.list')
+        if pcachefsutil.DEBUG:
+            debug('Cacher.readdir', path, offset)
+        result = self._mem_get(self._list_mem, path)
+        if result is not None:
+            return (fuse.Direntry(name) for name in result)
+
+        # Check the directory has not changed, which discards its
+        # cache.names if it has
+        self.getattr(path)
+
+        cache_dir = self._get_cache_dir(path, 'cache.names')
 
-        result = None
         if os.path.exists(cache_dir):
-            with __builtin__.open(cache_dir, 'rb') as list_cache_file:
-                result = pickle.load(list_cache_file)
+            with builtins.open(cache_dir, 'rb') as list_cache_file:
+                content = list_cache_file.read()
+
+            result = os.fsdecode(content).split('\0') if content else []
 
         else:
             result_generator = self.underlying_fs.readdir(path, offset)
-            result = list(result_generator)
+            result = [entry.name for entry in result_generator]
 
             self._create_cache_dir(path)
-            with __builtin__.open(cache_dir, 'wb') as list_cache_file:
-                pickle.dump(result, list_cache_file)
+            # Names are separated by NUL as, unlike newline, it cannot
+            # appear in a file name
+            with builtins.open(cache_dir, 'wb') as list_cache_file:
+                list_cache_file.write(os.fsencode('\0'.join(result)))
+
+        self._mem_put(self._list_mem, path, result, self.list_ttl)
 
         # Return a new generator over our list of items
-        return (x for x in result)
+        return (fuse.Direntry(name) for name in result)
 
+    @_synchronized
     def getattr(self, path):
-        """Retrieve stat information for a particular file from the cache."""
-        debug('Cacher.getattr', path)
-        cache_dir = self._get_cache_dir(path, 'cache.stat')
+        """Retrieve stat information for a particular file from the cache.
 
-        result = None
-        if os.path.exists(cache_dir):
-            with __builtin__.open(cache_dir, 'rb') as stat_cache_file:
-                result = pickle.load(stat_cache_file)
+        Stat information loaded from cache.meta is checked against the
+        underlying filesystem. If the file's modification time or size
+        has changed, everything cached for it is discarded. Information
+        served from memory is not checked until it expires, nor is that
+        of directories checked less than list_ttl seconds ago.
+        """
+        if pcachefsutil.DEBUG:
+            debug('Cacher.getattr', path)
+        result = self._mem_get(self._stat_mem, path)
+        if result is not None:
+            return result
+
+        cache_meta = self._get_cache_dir(path, 'cache.meta')
+
+        try:
+            with builtins.open(cache_meta, 'rb') as meta_file:
+                packed = meta_file.read(_STAT_STRUCT.size)
+                meta_mtime = os.fstat(meta_file.fileno()).st_mtime
+        except FileNotFoundError:
+            packed = b''
+
+        if len(packed) == _STAT_STRUCT.size:
+            result = FuseStat.from_tuple(_STAT_STRUCT.unpack(packed))
+
+            # Directories are looked up far more often than they change,
+            # so the modification time of cache.meta records when they
+            # were last checked
+            if not stat.S_ISDIR(result.st_mode):
+                result = self._validate(path, result)
+            elif time.time() - meta_mtime >= self.list_ttl:
+                result = self._validate(path, result)
+                os.utime(cache_meta)
 
         else:
             result = self.underlying_fs.getattr(path)
 
             self._create_cache_dir(path)
-            with __builtin__.open(cache_dir, 'wb') as stat_cache_file:
-                pickle.dump(result, stat_cache_file)
+            self._write_meta(path, result)
 
+        self._mem_put(self._stat_mem, path, result, self.stat_ttl)
         return result
 
+    def _validate(self, path, cached_stat):
+        """Return the stat to use for path, discarding its cached content if it has changed."""
+        try:
+            current_stat = self.underlying_fs.getattr(path)
+        except OSError:
+            # The underlying file may be gone or unreachable, in which
+            # case we keep serving what we have
+            return cached_stat
+
+        if (current_stat.st_mtime, current_stat.st_size) == (cached_stat.st_mtime, cached_stat.st_size):
+            return cached_stat
+
+        if pcachefsutil.DEBUG:
+            debug('Cacher._validate changed', path)
+
+        self._discard(path, current_stat)
+        return current_stat
+
+    def _discard(self, path, file_stat):
+        """Forget the cached content of path, which now has the given stat."""
+        self._close_cached_fds(path)
+        self._ranges_mem.pop(path, None)
+        self._ranges_dirty.discard(path)
+        self._list_mem.pop(path, None)
+
+        try:
+            os.remove(self._get_cache_dir(path, 'cache.names'))
+        except FileNotFoundError:
+            pass
+
+        try:
+            fd = os.open(self._get_cache_dir(path, 'cache.data'), os.O_WRONLY)
+        except FileNotFoundError:
+            pass
+        else:
+            try:
+                os.ftruncate(fd, 0)
+                preallocate(fd, file_stat.st_size)
+            finally:
+                os.close(fd)
+
+        self._write_meta(path, file_stat)
+
+    def _write_meta(self, path, file_stat):
+        """Write the cache.meta file for path, with the given stat and no cached ranges."""
+        with builtins.open(self._get_cache_dir(path, 'cache.meta'), 'wb') as meta_file:
+            meta_file.write(_STAT_STRUCT.pack(*file_stat.to_tuple()) + _RANGE_COUNT_STRUCT.pack(0))
+
     def write(self, path, buf, offset):  # pylint: disable=no-self-use
-        debug('Cacher.write', path, buf, offset)
+        if pcachefsutil.DEBUG:
+            debug('Cacher.write', path, buf, offset)
         return E_NOT_IMPL
 
-    def _get_cache_dir(self, path, file = None):
-        """For a given path, return the name of the directory used to cache data for that path."""
-        if path[0] != '/':
-            raise ValueError("Expected leading slash")
+    def _mem_get(self, mem, path):  # pylint: disable=no-self-use
+        """Look up path in one of the in-memory caches, marking it as recently used.
+
+        Expired entries are dropped and treated as missing.
+        """
+        entry = mem.get(path)
+        if entry is None:
+            return None
+
+        value, expiry = entry
+        if expiry < time.monotonic():
+            del mem[path]
+            return None
+
+        mem.move_to_end(path)
+        return value
+
+    def _mem_put(self, mem, path, value, ttl):  # pylint: disable=no-self-use
+        """Store value for path in one of the in-memory caches, evicting the least recently used entry if full."""
+        mem[path] = (value, time.monotonic() + ttl)
+        mem.move_to_end(path)
 
-        if file is None:
-            return os.path.join(self.cachedir, path[1:])
+        if len(mem) > MEM_CACHE_SIZE:
+            mem.popitem(last=False)
+
+    def _invalidate_mem(self, path):
+        """Drop any in-memory cached metadata for path."""
+        self._stat_mem.pop(path, None)
+        self._list_mem.pop(path, None)
+
+    def _get_cached_fd(self, path, writable=False):
+        """Return an open file descriptor on the cache.data file for path.
+
+        Descriptors are kept open and reused across calls, the least
+        recently used one being closed once FD_CACHE_SIZE are open.
+        """
+        fds = self._rw_fd_cache if writable else self._fd_cache
 
-        return os.path.join(self.cachedir, path[1:], file)
+        fd = fds.get(path)
+        if fd is not None:
+            fds.move_to_end(path)
+            return fd
+
+        cache_data = self._get_cache_dir(path, 'cache.data')
+        fd = os.open(cache_data, os.O_RDWR if writable else os.O_RDONLY)
+
+        if len(fds) >= FD_CACHE_SIZE:
+            evicted_path, evicted_fd = fds.popitem(last=False)
+            if not writable:
+                self._close_mmap(evicted_path)
+            os.close(evicted_fd)
+
+        fds[path] = fd
+
+        if not writable:
+            # Only map cache.data once it covers the whole file, as the
+            # map would not grow with it. The stat is taken from memory,
+            # where reads have just put it, as getattr() may discard the
+            # descriptor we are returning.
+            data_size = os.fstat(fd).st_size
+            file_stat = self._mem_get(self._stat_mem, path)
+            if data_size >= MMAP_THRESHOLD and file_stat is not None and data_size >= file_stat.st_size:
+                self._mmap_cache[path] = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+        return fd
+
+    def _close_cached_fds(self, path):
+        """Close any file descriptors held open on the cache.data file for path.
+
+        Any held open on the underlying file are closed too, so that the
+        data is next fetched from the file currently at path.
+        """
+        self._close_mmap(path)
+
+        for fds in (self._fd_cache, self._rw_fd_cache):
+            fd = fds.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+
+        if hasattr(self.underlying_fs, 'close_fd'):
+            self.underlying_fs.close_fd(path)
+
+    def _close_mmap(self, path):
+        """Unmap the cache.data file for path, if it is mapped."""
+        mm = self._mmap_cache.pop(path, None)
+        if mm is not None:
+            mm.close()
+
+    def _get_cache_dir(self, path, file = None):
+        """For a given path, return the name of the directory used to cache data for that path."""
+        return _cache_path(self.cachedir, path, file)
 
     def _create_cache_dir(self, path):
         """Create the cache path for the given directory if it does not already exist."""
@@ -459,8 +1106,7 @@ class Cacher(object):
 
     def _mkdir(self, path):  # pylint: disable=no-self-use
         """Create the given directory if it does not already exist."""
-        if not os.path.exists(path):
-            os.makedirs(path)
+        os.makedirs(path, exist_ok=True)
 
 
 def main(args=None):
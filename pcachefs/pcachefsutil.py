@@ -1,14 +1,16 @@
 """
 Utility methods used across pcachefs.
 """
+import ctypes
 import errno
 import os
 import sys
 
-DEBUG = True
+# Callers check this before calling debug(), so that no arguments are
+# built when it is off. Set by the --debug option.
+DEBUG = False
 def debug(*words):
-    if DEBUG:
-        sys.stderr.write('DEBUG: %s\n' % ' '.join(str(word) for word in words))
+    sys.stderr.write('DEBUG: %s\n' % ' '.join(str(word) for word in words))
 
 # Error codes
 # source: /usr/lib/syslinux/com32/include/errno.h
@@ -24,3 +26,95 @@ E_INVALID_ARG = -errno.EINVAL
 def is_read_only_flags(flags):
     access_flags = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
     return flags & access_flags == os.O_RDONLY
+
+
+def _load_fallocate():
+    """Return a function reserving disk space for a file, or None if there is none to use.
+
+    On Linux this is fallocate() from the C library, which fails when
+    the filesystem does not support it. glibc's posix_fallocate()
+    instead emulates it by writing every block of the file.
+    """
+    if not sys.platform.startswith('linux'):
+        return getattr(os, 'posix_fallocate', None)
+
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        c_fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+    except (OSError, AttributeError):
+        return None
+
+    c_fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    c_fallocate.restype = ctypes.c_int
+
+    def fallocate(fd, offset, size):
+        if c_fallocate(fd, 0, offset, size) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    return fallocate
+
+_fallocate = _load_fallocate()
+
+
+def preallocate(fd, size):
+    """Extend the file open at fd to size bytes, reserving disk space for them if possible.
+
+    If the space cannot be reserved, e.g. the filesystem does not
+    support it or does not have enough free space, the file is left
+    sparse.
+    """
+    if size <= 0:
+        return
+
+    if _fallocate is not None:
+        try:
+            _fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass
+
+    os.ftruncate(fd, size)
+
+
+def copy_range(src_fd, dst_fd, offset, count):
+    """Copy count bytes at offset in src_fd to the same offset in dst_fd.
+
+    The copy is done in the kernel with os.copy_file_range() (Linux
+    only) or os.sendfile() where available and supported, otherwise by
+    reading and writing the data. Returns the number of bytes copied,
+    which is less than count if the end of src_fd was reached.
+    """
+    copied = 0
+    while copied < count:
+        n = _copy_chunk(src_fd, dst_fd, offset + copied, count - copied)
+        if n == 0:
+            break
+        copied += n
+
+    return copied
+
+
+def _copy_chunk(src_fd, dst_fd, offset, count):
+    if hasattr(os, 'copy_file_range'):
+        try:
+            return os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+        except OSError as e:
+            # e.g. the files are on different filesystems
+            if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                raise
+
+    if hasattr(os, 'sendfile'):
+        # sendfile() writes at the current position of dst_fd
+        os.lseek(dst_fd, offset, os.SEEK_SET)
+        try:
+            return os.sendfile(dst_fd, src_fd, offset, count)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+
+    data = os.pread(src_fd, count, offset)
+    if not data:
+        return 0
+
+    return os.pwrite(dst_fd, data, offset)
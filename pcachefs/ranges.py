@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
 """
    Range and Ranges classes used by pCacheFS
@@ -19,6 +19,20 @@
 
 """
 
+import bisect
+import functools
+import struct
+
+
+def _range_key(other):
+    """Key to compare a Range with other, which may be a Range or a number."""
+    if type(other) == Range:
+        return (other.start, other.end)
+
+    return (other, other)
+
+
+@functools.total_ordering
 class Range(object):
     """Represents a range of integers (i.e. a start and an end)."""
     def __init__(self, start, end):
@@ -33,22 +47,20 @@ class Range(object):
     def __repr__(self):
         return 'Range ' + str(self.start )+ '..' + str(self.end)
 
-    def __cmp__(self, other):
-        if type(other) == Range:
-            if self.start == other.start:
-                return cmp(self.end, other.end)
-            return cmp(self.start, other.start)
+    def __eq__(self, other):
+        return (self.start, self.end) == _range_key(other)
+
+    def __lt__(self, other):
+        return (self.start, self.end) < _range_key(other)
 
-        else:
-            if self.start == other:
-                return cmp(self.end, other)
-            return cmp(self.start, other)
+    def __hash__(self):
+        return hash((self.start, self.end))
 
     def contains(self, i):
         if type(i) == Range:
             return i.start >= self.start and i.end <= self.end
 
-        return i >= self.start and i <= self.end
+        return self.start <= i <= self.end
 
 class Ranges(object):
     """A group of ranges.
@@ -91,6 +103,10 @@ class Ranges(object):
     def __init__(self):
         self.ranges = []
 
+        # start of each item in ranges, kept alongside it so it can be
+        # binary searched without calling Range.__lt__
+        self._starts = []
+
         # start and end of the entire range (ie the start point of the
         # starting range to the end point of the finishing range)
         self.start = 0
@@ -99,37 +115,49 @@ class Ranges(object):
     def __repr__(self):
         return str(self.ranges)
 
-    def _cleanup(self):
-        old_ranges = list(self.ranges)
-        old_ranges.sort()
+    def pack(self):
+        """Serialise to bytes of little-endian int64 (start, end) pairs."""
+        values = []
+        for r in self.ranges:
+            values.append(r.start)
+            values.append(r.end)
 
-        i = 0
-        while i < (len(old_ranges)-1):
-            # get the next item, compare it with the item that follows it
-            item = old_ranges[i]
-            next_item = old_ranges[i+1]
+        return struct.pack('<%dq' % len(values), *values)
 
-            if item.end >= next_item.start:
-                old_ranges.pop(i)
-                old_ranges.pop(i) # effectively this removes item at i+1
+    @classmethod
+    def unpack(cls, data):
+        """Create a Ranges from bytes produced by pack()."""
+        values = struct.unpack('<%dq' % (len(data) // 8), data)
 
-                new_range = Range(item.start, max(item.end, next_item.end))
-                old_ranges.append(new_range)
-                old_ranges.sort()
+        result = cls()
+        result.ranges = [Range(values[i], values[i+1]) for i in range(0, len(values), 2)]
+        result._starts = list(values[0::2])
+        if result.ranges:
+            result.start = result.ranges[0].start
+            result.end = result.ranges[-1].end
 
-            else:
-                # only move to the next item of the list if we didn't modify
-                # the current item
-                i += 1
+        return result
 
-        self.ranges = old_ranges
+    def _find(self, i):
+        """Return the index of the last item starting at or before i, or -1 if there is none."""
+        return bisect.bisect_right(self._starts, i) - 1
+
+    def add_range(self, range):
+        # items from lo up to (but excluding) hi overlap or touch range,
+        # so are replaced by a single item covering all of them
+        lo = self._find(range.start)
+        if lo < 0 or self.ranges[lo].end < range.start:
+            lo += 1
+        hi = bisect.bisect_right(self._starts, range.end)
+
+        if lo < hi:
+            range = Range(min(range.start, self.ranges[lo].start), max(range.end, self.ranges[hi-1].end))
+
+        self.ranges[lo:hi] = [range]
+        self._starts[lo:hi] = [range.start]
 
         self.start = self.ranges[0].start
         self.end = self.ranges[-1].end
-
-    def add_range(self, range):
-        self.ranges.append(range)
-        self._cleanup()
         return self
 
     def add_ranges(self, ranges):
@@ -148,11 +176,10 @@ class Ranges(object):
         object (i.e. its start and end are completely 'inside' or equal
         to a Range in this Ranges).
         """
-        for r in self.ranges:
-            if r.contains(i):
-                return True
-
-        return False
+        # items never overlap or touch, so the only one that can contain
+        # i is the last one starting at or before it
+        index = self._find(i.start if type(i) == Range else i)
+        return index >= 0 and self.ranges[index].contains(i)
 
     def number(self):
         num = 0
@@ -173,90 +200,49 @@ class Ranges(object):
          (3,4) (10,12)
 
         """
-        portions = []
-
-        # if we have no ranges added then none of the given range will
-        # be covered
-        if not self.ranges:
-            return [ range ]
-
         # if the search range doesn't overlap any items in this range
         # this nothing in this range will cover any of the search range
-        if range.end <= self.start or range.start >= self.end:
+        if not self.ranges or range.end <= self.start or range.start >= self.end:
             return [ range ]
 
-        search_range = Range(range.start, range.end)
-        i = 0
-        while i < len(self.ranges):
-            item = self.ranges[i]
+        portions = []
 
-            if item.contains(search_range):
-                # if search_range is entirely contained, exit loop (return empty list)
+        # walk the items overlapping range, starting from the last one
+        # that begins at or before it, adding the gaps between them
+        position = range.start
+        i = max(self._find(range.start), 0)
+        while i < len(self.ranges) and position < range.end:
+            item = self.ranges[i]
+            if item.start >= range.end:
                 break
 
-            elif not item.contains(search_range.start):
-                # if search_range.start doesn't fall within this item,
-                # either search_range begins before item.start, or after
-                # item.end
-
-                if search_range.start < item.start:
-
-                    if search_range.end < item.start:
-                        # if search_range ends before this item (ie
-                        # never overlaps) then add a portion
-                        # representing the entire search_range and exit
-                        # the loop, since we've now gone as far as the
-                        # end of the search_range
-                        portions.append(Range(search_range.start, search_range.end))
-                        break
-
-                    else:
-                        # if search_range begins before this item starts
-                        # (and it overlaps with this item), add
-                        # a portion to account for the space between
-                        # search_range.start and item.start, move
-                        # beginning of search_range to item.start, and
-                        # re-run loop without moving to the next item
-
-                        portions.append(Range(search_range.start, item.start))
-                        search_range = Range(item.start, search_range.end)
-
-                else:
-                    # if this item does not overlap search range at all,
-                    # ignore this item
-                    i += 1 # move to next item
-
-            else:
-                # if overlaps, then move the search_range up to begin at
-                # the end of this item (since it is 'covered' up to the
-                # end of this
-                # item)
-                search_range = Range(item.end, search_range.end)
-
-                # get the next item (because of _cleanup, we know that
-                # there will be space between item and next_item)
-                next_item = None
-                if i < len(self.ranges)-1:
-                    next_item = self.ranges[i+1]
-
-                if next_item is None or search_range.end <= next_item.start:
-                    # if our search_range finishes before we get to the
-                    # next item, then add a portion for search_range,
-                    # and exit (since we've finished)
-
-                    portions.append(Range(search_range.start, search_range.end))
-                    break
-
-                else:
-                    # if our search_range strays into the next_item
-                    # range, add a portion to cover the space up to the
-                    # beginning of the next item, then move the
-                    # beginning of search_range up to the next item and
-                    # re-run loop
-
-                    portions.append(Range(search_range.start, next_item.start))
-                    search_range = Range(next_item.start, search_range.end)
-
-                    i += 1 # move to next item
+            if item.start > position:
+                portions.append(Range(position, item.start))
+
+            position = max(position, item.end)
+            i += 1
+
+        if position < range.end:
+            portions.append(Range(position, range.end))
 
         return portions
+
+
+def coalesce(ranges, max_gap):
+    """Merge Range objects that are separated by no more than max_gap.
+
+    ranges need not be sorted or disjoint. Returns a new, sorted list of
+    Range objects, for example with a max_gap of 2:
+     (0,3) (4,6) (10,12)
+
+    becomes:
+     (0,6) (10,12)
+    """
+    result = []
+    for r in sorted(ranges, key=lambda r: (r.start, r.end)):
+        if result and r.start - result[-1].end <= max_gap:
+            last = result.pop()
+            r = Range(last.start, max(last.end, r.end))
+        result.append(r)
+
+    return result
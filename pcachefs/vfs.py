@@ -1,11 +1,13 @@
+import copy
 import os
 import stat
 import time
 
 import fuse
 
-from pcachefsutil import debug, is_read_only_flags
-from pcachefsutil import (E_NO_SUCH_FILE, E_PERM_DENIED, E_NOT_IMPL)
+from . import pcachefsutil
+from .pcachefsutil import debug, is_read_only_flags
+from .pcachefsutil import (E_NO_SUCH_FILE, E_PERM_DENIED, E_NOT_IMPL)
 
 
 class SimpleVirtualFile(object):
@@ -174,6 +176,10 @@ class VirtualFS(object):
         self.root = root
         self.cacher = cacher
 
+        # Path of the root folder, and prefix of the paths within it
+        self.root_path = os.sep + root
+        self.root_prefix = self.root_path + os.sep
+
     def get_relative_path(self, path):
         """Returns path relative to the given root virtual folder."""
         path_xpl = path.split(os.sep)
@@ -185,12 +191,13 @@ class VirtualFS(object):
 
     def contains(self, path):
         """Returns true if the given path exists as a virtual file."""
-        return self.get_relative_path(path) is not None
+        return path == self.root_path or path.startswith(self.root_prefix)
 
 
     def getattr(self, path):
         """Retrieve attributes of a path in the VirtualFS."""
-        debug('VirtualFS.getattr', path)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.getattr', path)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
@@ -202,12 +209,14 @@ class VirtualFS(object):
                 return E_NO_SUCH_FILE
             return self.cacher.getattr(parent_path)
         else:
-            a = self.cacher.getattr(os.sep + virtual_path)
+            # Copy, as the cacher hands out the instance it keeps in memory
+            a = copy.copy(self.cacher.getattr(os.sep + virtual_path))
             a.st_mode = stat.S_IFDIR | 0o777
             return a
 
     def readdir(self, path, offset):
-        debug('VirtualFS.readdir', path, offset)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.readdir', path, offset)
         virtual_path = self.get_relative_path(path)
         if virtual_path is not None:
             is_file = stat.S_ISREG(self.cacher.getattr(os.sep + virtual_path).st_mode)
@@ -222,7 +231,8 @@ class VirtualFS(object):
             yield fuse.Direntry(self.root)
 
     def open(self, path, flags):
-        debug('VirtualFS.open', path, flags)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.open', path, flags)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
@@ -236,7 +246,8 @@ class VirtualFS(object):
         return 0
 
     def read(self, path, size, offset):
-        debug('VirtualFS.read', path, size, offset)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.read', path, size, offset)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
@@ -251,20 +262,23 @@ class VirtualFS(object):
             return E_NO_SUCH_FILE
 
         attr = self.cacher.getattr(parent_path)
-        return str(self.cacher.get_cached_blocks(parent_path).number() / float(attr.st_size * attr.st_blksize))
+        return str(self.cacher.get_cached_blocks(parent_path).number() / float(attr.st_size * attr.st_blksize)).encode()
 
     def mknod(self, path, mode, dev):  # pylint: disable=no-self-use
-        debug('VirtualFS.mknod', path, mode, dev)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.mknod', path, mode, dev)
         # Don't allow creation of new files
         return E_PERM_DENIED
 
     def unlink(self, path):  # pylint: disable=no-self-use
-        debug('VirtualFS.unlink', path)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.unlink', path)
         # Don't allow removal of files
         return E_PERM_DENIED
 
     def write(self, path, buf, offset):
-        debug('VirtualFS.write', path, buf, offset)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.write', path, buf, offset)
         virtual_path = self.get_relative_path(path)
         if virtual_path is None:
             return E_NO_SUCH_FILE
@@ -272,11 +286,11 @@ class VirtualFS(object):
         basename = os.path.basename(virtual_path)
         if basename == 'cached':
             real_path = os.sep + os.path.dirname(virtual_path)
-            if buf == '1':
+            if buf == b'1':
                 attr = self.cacher.underlying_fs.getattr(real_path)
                 size = attr.st_size * attr.st_blksize
                 self.cacher.read(real_path, size, 0, force_reload=True)
-            elif buf == '0':
+            elif buf == b'0':
                 self.cacher.remove_cached_data(real_path)
             else:
                 return E_NOT_IMPL
@@ -285,15 +299,18 @@ class VirtualFS(object):
             return E_NO_SUCH_FILE
 
     def truncate(self, path, size):  # pylint: disable=no-self-use
-        debug('VirtualFS.truncate', path, size)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.truncate', path, size)
         return 0
 
     def flush(self, path, fh=None):  # pylint: disable=no-self-use, unused-argument
-        debug('VirtualFS.flush', path)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.flush', path)
         return 0
 
     def release(self, path, fh=None):  # pylint: disable=no-self-use, unused-argument
-        debug('VirtualFS.release', path)
+        if pcachefsutil.DEBUG:
+            debug('VirtualFS.release', path)
         return 0
 
 
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 from setuptools import setup
 
 setup(
@@ -16,9 +16,10 @@ setup(
     },
     packages=['pcachefs'],
 
-    install_requires=['fuse-python'],
+    python_requires='>=3.8',
+    install_requires=['fuse-python>=1.0.0'],
     extras_require={
         'dev': ['ipython'],
-        'test': ['mockito', 'pytest', 'pylint']
+        'test': ['mockito', 'pytest', 'pylint>=2.14']
     },
 )
@@ -12,6 +12,9 @@ import pytest
 
 from pcachefs import main
 
+# Maximum number of seconds to wait for pcachefs to mount
+MOUNT_TIMEOUT = 10
+
 
 @pytest.fixture
 def rootdir():
@@ -46,18 +49,37 @@ def mountdir(rootdir):
     yield dir
 
 
-@pytest.fixture
-def pcachefs(sourcedir, cachedir, mountdir):
+def run_pcachefs(sourcedir, cachedir, mountdir, *options):
     signal.signal(signal.SIGINT, signal.SIG_DFL)
-    p = Process(target=main, args=(['-d', '-s', '-c', cachedir, '-t', sourcedir, mountdir],))
+    p = Process(target=main, args=(['-d', '-s', '--debug'] + list(options) + ['-c', cachedir, '-t', sourcedir, mountdir],))
     p.start()
+
+    # Wait for the mount, so that tests do not see the bare mount dir
+    deadline = time.monotonic() + MOUNT_TIMEOUT
+    while not os.path.ismount(mountdir):
+        if not p.is_alive() or time.monotonic() > deadline:
+            os.kill(p.pid, signal.SIGINT)
+            p.join()
+            pytest.fail('pcachefs did not mount ' + mountdir)
+        time.sleep(.01)
+
     yield
     os.kill(p.pid, signal.SIGINT)
     p.join()
 
 
+@pytest.fixture
+def pcachefs(sourcedir, cachedir, mountdir):
+    yield from run_pcachefs(sourcedir, cachedir, mountdir)
+
+
+@pytest.fixture
+def pcachefs_no_ttl(sourcedir, cachedir, mountdir):
+    yield from run_pcachefs(sourcedir, cachedir, mountdir, '--stat-ttl', '0', '--list-ttl', '0')
+
+
 def write_to_file(dirname, path, content):
-    with open(os.path.join(dirname, *path), 'w') as f:
+    with open(os.path.join(dirname, *path), 'w', encoding='utf-8') as f:
         f.write(content)
     # Needed to let pcachefs propagate changes
     time.sleep(.1)
@@ -71,7 +93,7 @@ def create_directory(dirname, path):
 
 def read_from_file(dirname, path):
     try:
-        with open(os.path.join(dirname, *path), 'r') as f:
+        with open(os.path.join(dirname, *path), 'r', encoding='utf-8') as f:
             return f.read()
     except IOError as e:
         print('Could not open', os.path.join(dirname, *path), e)
@@ -113,7 +135,6 @@ def list_dir(dirname, path=None):
 
 def test_create_file(pcachefs, sourcedir, mountdir):
     assert 'a' not in list_dir(sourcedir)
-    assert 'a' not in list_dir(mountdir)
     assert read_from_file(sourcedir, ['a']) is None
     assert read_from_file(mountdir, ['a']) is None
 
@@ -135,6 +156,25 @@ def test_cached_file_not_updated(pcachefs, sourcedir, mountdir):
     assert read_from_file(mountdir, ['a']) == '1'
 
 
+def test_changed_file_reloaded(pcachefs_no_ttl, sourcedir, mountdir):
+    write_to_file(sourcedir, ['a'], '1')
+    # load in cache
+    read_from_file(mountdir, ['a'])
+    write_to_file(sourcedir, ['a'], '22')
+    # Let the kernel attribute cache expire
+    time.sleep(1.1)
+    assert read_from_file(mountdir, ['a']) == '22'
+
+
+def test_changed_directory_reloaded(pcachefs_no_ttl, sourcedir, mountdir):
+    create_directory(sourcedir, ['a'])
+    write_to_file(sourcedir, ['a', 'a'], '1')
+    # load in cache
+    assert list_dir(mountdir, ['a']) == ListDir(['a'], [])
+    write_to_file(sourcedir, ['a', 'b'], '2')
+    assert list_dir(mountdir, ['a']) == ListDir(['a', 'b'], [])
+
+
 def test_only_cached_file_at_read(pcachefs, sourcedir, mountdir):
     write_to_file(sourcedir, ['a'], '1')
     write_to_file(sourcedir, ['a'], '2')
@@ -146,7 +186,6 @@ def test_only_cached_file_at_read(pcachefs, sourcedir, mountdir):
 
 def test_create_directory(pcachefs, sourcedir, mountdir):
     assert 'a' not in list_dir(sourcedir)
-    assert 'a' not in list_dir(mountdir)
     assert read_from_file(sourcedir, ['a']) is None
     assert read_from_file(mountdir, ['a']) is None
 
@@ -162,7 +201,6 @@ def test_create_directory(pcachefs, sourcedir, mountdir):
 
 def test_cached_directory_not_updated(pcachefs, sourcedir, mountdir):
     assert 'a' not in list_dir(sourcedir)
-    assert 'a' not in list_dir(mountdir)
     assert read_from_file(sourcedir, ['a']) is None
     assert read_from_file(mountdir, ['a']) is None
 
@@ -189,6 +227,14 @@ def test_cached_directory_not_updated(pcachefs, sourcedir, mountdir):
     assert read_from_file(mountdir, ['a', 'b']) == '3'
 
 
+def test_newline_in_name(pcachefs_no_ttl, sourcedir, mountdir):
+    write_to_file(sourcedir, ['a\nb'], '1')
+    assert list_dir(mountdir) == ListDir(['a\nb'], ['.pcachefs'])
+    # listed again, from cache.names
+    assert list_dir(mountdir) == ListDir(['a\nb'], ['.pcachefs'])
+    assert read_from_file(mountdir, ['a\nb']) == '1'
+
+
 def test_read_cache(pcachefs, sourcedir, mountdir):
     write_to_file(sourcedir, ['a'], '1')
     assert list_dir(mountdir) == ListDir(['a'], ['.pcachefs'])
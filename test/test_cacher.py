@@ -0,0 +1,240 @@
+#For pytest, pylint: disable=redefined-outer-name, unused-argument
+
+import os
+import struct
+import threading
+import time
+
+import pytest
+
+from pcachefs import pcachefs
+from pcachefs.pcachefs import Cacher, UnderlyingFs
+from pcachefs.ranges import Range
+
+MB = 1024 * 1024
+
+
+@pytest.fixture
+def sourcedir(tmp_path):
+    path = tmp_path / 'source'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture
+def cachedir(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+@pytest.fixture
+def cachers(sourcedir, cachedir):
+    """Factory of Cachers over sourcedir and cachedir, flushed at the end of the test."""
+    created = []
+
+    def make():
+        cacher = Cacher(cachedir, UnderlyingFs(sourcedir))
+        created.append(cacher)
+        return cacher
+
+    yield make
+
+    for cacher in created:
+        cacher.flush_all()
+
+
+@pytest.fixture
+def cacher(cachers):
+    return cachers()
+
+
+@pytest.fixture
+def gate(monkeypatch):
+    """Make copies done by the read-ahead worker wait until gate.set() is called."""
+    event = threading.Event()
+    copy_range = pcachefs.copy_range
+
+    def gated_copy_range(*args):
+        if threading.current_thread().name == 'pcachefs-prefetch':
+            event.wait()
+        return copy_range(*args)
+
+    monkeypatch.setattr(pcachefs, 'copy_range', gated_copy_range)
+    yield event
+    event.set()
+
+
+def write_source(sourcedir, name, size):
+    data = os.urandom(size)
+    with open(os.path.join(sourcedir, name), 'wb') as f:
+        f.write(data)
+    return data
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(.01)
+
+
+def no_readahead(cacher):
+    cacher._schedule_readahead = lambda *args: None
+
+
+def test_read_large_file(cacher, sourcedir):
+    data = write_source(sourcedir, 'a', 3 * MB + 123)
+    for offset, size in [(0, 10), (MB - 5, 10), (2 * MB + 7, MB), (3 * MB, 500)]:
+        assert cacher.read('/a', size, offset) == data[offset:offset + size]
+    assert cacher.read('/a', 4 * MB, 0) == data
+
+
+def test_read_fills_aligned_chunks(cacher, sourcedir):
+    no_readahead(cacher)
+    write_source(sourcedir, 'a', 3 * MB)
+    cacher.read('/a', 10, MB + 5)
+    assert cacher.get_cached_blocks('/a').ranges == [Range(MB, 2 * MB)]
+
+
+def test_read_several_blocks(cacher, sourcedir):
+    no_readahead(cacher)
+    data = write_source(sourcedir, 'a', 6 * MB)
+    cacher.read('/a', 10, 0)
+    cacher.read('/a', 10, 2 * MB)
+    cacher.read('/a', 10, 4 * MB)
+
+    # The holes at 1MB and 3MB are fetched concurrently
+    assert cacher.read('/a', 5 * MB, 0) == data[:5 * MB]
+    assert cacher.get_cached_blocks('/a').ranges == [Range(0, 5 * MB)]
+
+
+def test_readahead(cacher, sourcedir):
+    data = write_source(sourcedir, 'a', 8 * MB)
+    cacher.read('/a', 10, 0)
+    wait_for(lambda: cacher.get_cached_blocks('/a').contains(Range(0, pcachefs.READAHEAD_SIZE)))
+    assert cacher.get_cached_data('/a', pcachefs.READAHEAD_SIZE, 0) == data[:pcachefs.READAHEAD_SIZE]
+
+
+def test_readahead_not_queued_at_end_of_file(cacher, sourcedir):
+    write_source(sourcedir, 'a', 200 * 1024)
+    cacher.read('/a', 10, 0)
+
+    # The whole file is cached by the first read, so nothing is left to read ahead
+    scheduled = []
+    cacher._schedule_prefetch = lambda *args: scheduled.append(args)
+    for i in range(20):
+        cacher.read('/a', 4096, i * 4096)
+    assert not scheduled
+
+
+def test_read_not_waiting_for_unrelated_prefetch(cacher, sourcedir, gate):
+    data = write_source(sourcedir, 'a', 8 * MB)
+    cacher.read('/a', 10, 0)
+    wait_for(lambda: '/a' in cacher._fetching)
+
+    # Outside what is being prefetched, so served while the copy is held
+    assert cacher.read('/a', 10, 7 * MB) == data[7 * MB:7 * MB + 10]
+    assert '/a' in cacher._fetching
+
+
+def test_read_waiting_for_overlapping_prefetch(cacher, sourcedir, gate):
+    data = write_source(sourcedir, 'a', 8 * MB)
+    cacher.read('/a', 10, 0)
+    wait_for(lambda: '/a' in cacher._fetching)
+
+    result = []
+    reader = threading.Thread(target=lambda: result.append(cacher.read('/a', 10, 2 * MB)))
+    reader.start()
+    reader.join(.2)
+    assert reader.is_alive()
+
+    gate.set()
+    reader.join(5)
+    assert result == [data[2 * MB:2 * MB + 10]]
+
+
+def test_invalidate_during_prefetch(cacher, sourcedir, gate):
+    data = write_source(sourcedir, 'a', 8 * MB)
+    cacher.read('/a', 10, 0)
+    wait_for(lambda: '/a' in cacher._fetching)
+
+    cacher.remove_cached_data('/a')
+    gate.set()
+    wait_for(lambda: not cacher._fetching and not cacher._readahead)
+
+    # What the prefetch copied is not recorded as cached
+    assert cacher.get_cached_blocks('/a').ranges == []
+    assert cacher.read('/a', 10, 2 * MB) == data[2 * MB:2 * MB + 10]
+
+
+def test_mmap_read(cacher, sourcedir):
+    size = 2 * pcachefs.MMAP_THRESHOLD
+    data = write_source(sourcedir, 'a', size)
+    assert cacher.read('/a', 10, 0) == data[:10]
+    assert '/a' in cacher._mmap_cache
+    assert cacher.read('/a', 100, size - 100) == data[size - 100:]
+
+
+def test_short_cache_data_not_mapped(cacher, sourcedir, cachedir):
+    data = write_source(sourcedir, 'a', 4 * MB)
+    os.makedirs(os.path.join(cachedir, 'a'))
+    with open(os.path.join(cachedir, 'a', 'cache.data'), 'wb') as f:
+        f.write(b'\0' * (MB + 5))
+
+    assert cacher.read('/a', 10, 0) == data[:10]
+    assert cacher.read('/a', 10, 3 * MB) == data[3 * MB:3 * MB + 10]
+
+
+def test_ranges_flushed(cachers, sourcedir, cachedir):
+    write_source(sourcedir, 'a', 3 * MB)
+    cacher = cachers()
+    no_readahead(cacher)
+    cacher.read('/a', 10, 0)
+
+    # Not on disk until flushed
+    assert cachers().get_cached_blocks('/a').ranges == []
+    cacher.flush('/a')
+    assert cachers().get_cached_blocks('/a').ranges == [Range(0, MB)]
+
+
+def test_cache_meta_round_trip(cachers, sourcedir):
+    data = write_source(sourcedir, 'a', 3 * MB)
+    cacher = cachers()
+    no_readahead(cacher)
+    cacher.read('/a', 10, 2 * MB)
+    cacher.flush_all()
+
+    cacher = cachers()
+    # st_atime is left out as reading the source file changes it
+    cached, source = cacher.getattr('/a'), os.stat(os.path.join(sourcedir, 'a'))
+    for field in ['st_ino', 'st_mode', 'st_size', 'st_mtime', 'st_ctime']:
+        assert getattr(cached, field) == getattr(source, field)
+    assert cacher.get_cached_blocks('/a').ranges == [Range(2 * MB, 3 * MB)]
+    assert cacher.read('/a', 10, 2 * MB) == data[2 * MB:2 * MB + 10]
+
+
+def test_cache_meta_with_bad_range_count(cachers, sourcedir, cachedir):
+    data = write_source(sourcedir, 'a', 3 * MB)
+    cacher = cachers()
+    cacher.read('/a', 10, 0)
+    cacher.flush_all()
+
+    cache_meta = os.path.join(cachedir, 'a', 'cache.meta')
+    with open(cache_meta, 'rb') as f:
+        meta = f.read()
+    with open(cache_meta, 'wb') as f:
+        f.write(meta[:96] + struct.pack('<I', 2) + meta[100:124])
+
+    cacher = cachers()
+    assert cacher.get_cached_blocks('/a').ranges == []
+    assert cacher.read('/a', 10, 0) == data[:10]
+
+
+def test_changed_file_discarded(cachers, sourcedir):
+    write_source(sourcedir, 'a', 10)
+    cacher = cachers()
+    cacher.read('/a', 10, 0)
+    cacher.flush_all()
+
+    time.sleep(.01)
+    data = write_source(sourcedir, 'a', 10)
+    assert cachers().read('/a', 10, 0) == data
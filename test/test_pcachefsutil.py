@@ -0,0 +1,71 @@
+#For pytest, pylint: disable=redefined-outer-name
+
+import errno
+import os
+
+import pytest
+
+from pcachefs import pcachefsutil
+from pcachefs.pcachefsutil import copy_range, preallocate
+
+SIZE = 3 * 1024 * 1024 + 123
+
+
+@pytest.fixture
+def files(tmp_path):
+    """Source data and fds of a source file holding it and of an empty destination file."""
+    data = os.urandom(SIZE)
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    src.write_bytes(data)
+    src_fd = os.open(str(src), os.O_RDONLY)
+    dst_fd = os.open(str(dst), os.O_WRONLY | os.O_CREAT)
+    yield data, src_fd, dst_fd, dst
+    os.close(src_fd)
+    os.close(dst_fd)
+
+
+def failing(err):
+    def fail(*args):
+        raise OSError(err, os.strerror(err))
+    return fail
+
+
+def check_copy(files):
+    data, src_fd, dst_fd, dst = files
+    offset = 1024 * 1024 + 5
+    assert copy_range(src_fd, dst_fd, offset, SIZE) == SIZE - offset
+    assert dst.read_bytes()[offset:] == data[offset:]
+
+
+def test_copy_range(files):
+    check_copy(files)
+
+
+def test_copy_range_without_copy_file_range(files, monkeypatch):
+    monkeypatch.setattr(os, 'copy_file_range', failing(errno.EXDEV), raising=False)
+    check_copy(files)
+
+
+def test_copy_range_without_sendfile(files, monkeypatch):
+    monkeypatch.setattr(os, 'copy_file_range', failing(errno.EXDEV), raising=False)
+    monkeypatch.setattr(os, 'sendfile', failing(errno.EINVAL), raising=False)
+    check_copy(files)
+
+
+def test_copy_range_error(files, monkeypatch):
+    monkeypatch.setattr(os, 'copy_file_range', failing(errno.EIO), raising=False)
+    with pytest.raises(OSError):
+        check_copy(files)
+
+
+def test_preallocate(files):
+    _, _, dst_fd, dst = files
+    preallocate(dst_fd, SIZE)
+    assert dst.stat().st_size == SIZE
+
+
+def test_preallocate_without_space(files, monkeypatch):
+    _, _, dst_fd, dst = files
+    monkeypatch.setattr(pcachefsutil, '_fallocate', failing(errno.ENOSPC))
+    preallocate(dst_fd, SIZE)
+    assert dst.stat().st_size == SIZE
@@ -0,0 +1,155 @@
+import pytest
+
+from pcachefs.ranges import Range, Ranges, coalesce
+
+
+def make_ranges(*pairs):
+    ranges = Ranges()
+    for start, end in pairs:
+        ranges.add_range(Range(start, end))
+    return ranges
+
+
+def as_pairs(ranges):
+    return [(r.start, r.end) for r in ranges]
+
+
+def check_invariant(ranges):
+    """Items are sorted, never overlap or touch, and _starts matches them."""
+    assert ranges._starts == [r.start for r in ranges.ranges]
+    for item, next_item in zip(ranges.ranges, ranges.ranges[1:]):
+        assert item.end < next_item.start
+    if ranges.ranges:
+        assert (ranges.start, ranges.end) == (ranges.ranges[0].start, ranges.ranges[-1].end)
+
+
+def test_range_must_not_be_empty():
+    with pytest.raises(ValueError):
+        Range(3, 3)
+
+
+def test_add_range_disjoint():
+    ranges = make_ranges((6, 10), (0, 3))
+    assert as_pairs(ranges.ranges) == [(0, 3), (6, 10)]
+    check_invariant(ranges)
+
+
+def test_add_range_merges_overlapping():
+    ranges = make_ranges((0, 3), (6, 10), (7, 15))
+    assert as_pairs(ranges.ranges) == [(0, 3), (6, 15)]
+    check_invariant(ranges)
+
+
+def test_add_range_merges_touching():
+    ranges = make_ranges((0, 3), (6, 15), (3, 5))
+    assert as_pairs(ranges.ranges) == [(0, 5), (6, 15)]
+    ranges.add_range(Range(5, 6))
+    assert as_pairs(ranges.ranges) == [(0, 15)]
+    ranges.add_range(Range(15, 16))
+    assert as_pairs(ranges.ranges) == [(0, 16)]
+    check_invariant(ranges)
+
+
+def test_add_range_already_covered():
+    ranges = make_ranges((0, 16), (1, 3))
+    assert as_pairs(ranges.ranges) == [(0, 16)]
+    check_invariant(ranges)
+
+
+def test_add_range_spanning_several():
+    ranges = make_ranges((0, 2), (4, 6), (8, 10), (12, 14), (1, 9))
+    assert as_pairs(ranges.ranges) == [(0, 10), (12, 14)]
+    check_invariant(ranges)
+
+
+def test_add_ranges():
+    ranges = Ranges().add_ranges([Range(8, 10), Range(0, 2), Range(2, 4)])
+    assert as_pairs(ranges.ranges) == [(0, 4), (8, 10)]
+    assert ranges.number() == 6
+    check_invariant(ranges)
+
+
+def test_contains_number():
+    ranges = make_ranges((0, 3), (6, 10))
+    assert not Ranges().contains(0)
+    assert ranges.contains(0)
+    assert ranges.contains(3)
+    assert not ranges.contains(4)
+    assert not ranges.contains(5)
+    assert ranges.contains(6)
+    assert ranges.contains(10)
+    assert not ranges.contains(11)
+    assert not ranges.contains(-1)
+
+
+def test_contains_range():
+    ranges = make_ranges((0, 3), (6, 10))
+    assert not Ranges().contains(Range(0, 1))
+    assert ranges.contains(Range(0, 3))
+    assert ranges.contains(Range(1, 2))
+    assert ranges.contains(Range(6, 10))
+    assert not ranges.contains(Range(2, 4))
+    assert not ranges.contains(Range(0, 10))
+    assert not ranges.contains(Range(5, 7))
+    assert not ranges.contains(Range(9, 11))
+
+
+def test_get_uncovered_portions():
+    ranges = make_ranges((0, 3), (5, 10), (12, 15))
+    assert as_pairs(ranges.get_uncovered_portions(Range(2, 13))) == [(3, 5), (10, 12)]
+    assert as_pairs(ranges.get_uncovered_portions(Range(1, 2))) == []
+    assert as_pairs(ranges.get_uncovered_portions(Range(0, 20))) == [(3, 5), (10, 12), (15, 20)]
+
+
+def test_get_uncovered_portions_outside():
+    ranges = make_ranges((5, 10))
+    assert as_pairs(Ranges().get_uncovered_portions(Range(0, 4))) == [(0, 4)]
+    assert as_pairs(ranges.get_uncovered_portions(Range(0, 5))) == [(0, 5)]
+    assert as_pairs(ranges.get_uncovered_portions(Range(10, 12))) == [(10, 12)]
+
+
+def test_get_uncovered_portions_ends_at_item_start():
+    ranges = make_ranges((0, 3), (8, 10))
+    assert as_pairs(ranges.get_uncovered_portions(Range(4, 8))) == [(4, 8)]
+    assert as_pairs(ranges.get_uncovered_portions(Range(2, 8))) == [(3, 8)]
+
+
+def test_coalesce():
+    assert as_pairs(coalesce([Range(10, 12), Range(0, 3), Range(4, 6)], 2)) == [(0, 6), (10, 12)]
+    assert as_pairs(coalesce([Range(0, 3), Range(5, 6)], 2)) == [(0, 6)]
+    assert as_pairs(coalesce([Range(0, 3), Range(6, 7)], 2)) == [(0, 3), (6, 7)]
+    assert as_pairs(coalesce([], 2)) == []
+
+
+def test_coalesce_overlapping():
+    assert as_pairs(coalesce([Range(0, 10), Range(2, 4), Range(5, 12)], 0)) == [(0, 12)]
+
+
+def test_coalesce_uncovered_portions_of_aligned_read():
+    # An aligned read may end exactly where a cached chunk starts
+    ranges = make_ranges((0, 1024), (4096, 8192), (12288, 16384))
+    assert as_pairs(ranges.get_uncovered_portions(Range(2048, 4096))) == [(2048, 4096)]
+    portions = ranges.get_uncovered_portions(Range(0, 16384))
+    assert as_pairs(coalesce(portions, 1024)) == [(1024, 4096), (8192, 12288)]
+    assert as_pairs(coalesce(portions, 4096)) == [(1024, 12288)]
+
+
+def test_pack_unpack():
+    ranges = make_ranges((0, 3), (6, 2 ** 40))
+    packed = ranges.pack()
+    assert len(packed) == 32
+    unpacked = Ranges.unpack(packed)
+    assert as_pairs(unpacked.ranges) == [(0, 3), (6, 2 ** 40)]
+    check_invariant(unpacked)
+    # still usable after unpacking
+    unpacked.add_range(Range(3, 6))
+    assert as_pairs(unpacked.ranges) == [(0, 2 ** 40)]
+    check_invariant(unpacked)
+
+
+def test_pack_unpack_empty():
+    assert Ranges().pack() == b''
+    unpacked = Ranges.unpack(b'')
+    assert unpacked.ranges == []
+    assert (unpacked.start, unpacked.end) == (0, 0)
+    check_invariant(unpacked)